@@ -1,15 +1,37 @@
 import argparse
+import copy
 import csv
+import multiprocessing
 import re
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+try:
+    # Only needed for CsvImporter.import_data_pandas
+    import pandas as pd
+except ImportError:
+    pd = None
 # this module helps in processing XML files.
 import xml.etree.ElementTree as ET
 from datetime import datetime
 
-# Regular expression to detect potential string values with missing quotes
+# Detection of potential string values with missing quotes: a value is
+# suspicious if it contains a letter but is neither quoted nor an SQL
+# function (or TRUE/FALSE).
 sql_fun = ['true', 'false', 'avg', 'count', 'first', 'last', 'max', 'min',
            'sum', 'ucase', 'lcase', 'mid', 'len', 'round', 'now', 'format']
-string_exp = re.compile('^(?!["\']|{}).*[a-z]'.format('|'.join(sql_fun)),
-                        re.IGNORECASE)
+sql_fun_set = frozenset(sql_fun)
+letter_exp = re.compile('[A-Za-z]')
+
+# Read buffer for CSV input; the default 8 KiB means a read() syscall for
+# every few rows on large files
+CSV_BUFFER_SIZE = 1 << 22
+
+# Write buffer for the SQL output
+SQL_BUFFER_SIZE = 1 << 22
+
+# Rows per task sent to the worker processes by CsvImporter.import_data
+PARALLEL_CHUNK_SIZE = 4096
 
 
 class CsvImporter(object):
@@ -17,9 +39,11 @@ class CsvImporter(object):
         self.path = path
         self.dialect = dialect
         # Flatten import_specs to {(table, instance): record_spec} "t,i,s" form
+        # The importer works on its own bound copies of the specs, so the
+        # same RecordSpec can be used for several tables and importers.
         flat_specs = {}
         for (t, table_spec) in import_specs.items():
-            specs = {(t, i): s for (i, s) in table_spec.items()}
+            specs = {(t, i): s._bind(t) for (i, s) in table_spec.items()}
             flat_specs.update(specs)
         # Create a XReference dependency map and sort it topologically
         dependency_map = {}
@@ -27,62 +51,337 @@ class CsvImporter(object):
             deps = set([(x.table_name, x.instance_name) for x
                         in s.attr_map.values() if isinstance(x, XReference)])
             dependency_map[path] = deps
-        sorted_keys = [val for sub in _toposort(dependency_map) for val in sub]
+        # Within a dependency level the specs are ordered by table (and
+        # instance), so specs of the same table are next to each other
+        dependency_map = _transitive_reduction(dependency_map)
+        sorted_keys = [val for sub in _toposort(dependency_map)
+                       for val in sorted(sub)]
         # Store sorted results in a list [(t, i, s), ...]
-        try:
-            self.specs = [(t, i, flat_specs[(t, i)]) for (t, i) in sorted_keys]
-        except KeyError:
-            print('ERROR: Could not find specification for "{}" in table '
-                  '"{}". Check your XReferences.'.format(i, t))
-            exit(-1)
-
-    def import_data(self, id_col=None):
-        records = []
-        with open(self.path) as f:
+        for (t, i) in sorted_keys:
+            if (t, i) not in flat_specs:
+                print('ERROR: Could not find specification for "{}" in table '
+                      '"{}". Check your XReferences.'.format(i, t))
+                exit(-1)
+        self.specs = [(t, i, flat_specs[(t, i)]) for (t, i) in sorted_keys]
+        self._bind_xrefs(flat_specs)
+
+    def _bind_xrefs(self, flat_specs):
+        # Point every XReference directly at the spec it refers to, so that
+        # records can be looked up by spec instead of by (table, instance)
+        for (t, i, s) in self.specs:
+            for (k, v) in s.attr_map.items():
+                if isinstance(v, XReference):
+                    target = flat_specs[(v.table_name, v.instance_name)]
+                    s.dynamic_map[k] = _BoundXRef(target, v.attribute_name)
+
+    def import_data(self, id_col=None, workers=None):
+        # Records are yielded row by row so that only the current row (and
+        # its XReference map) is held in memory, not the whole CSV file.
+        # With workers > 1, chunks of rows are converted in a process pool.
+        with open(self.path, 'r', buffering=CSV_BUFFER_SIZE,
+                  newline='') as f:
             csv.register_dialect('user_data', **self.dialect)
-            reader = csv.DictReader(f, dialect='user_data')
+            reader = csv.reader(f, dialect='user_data')
+            # Column names are resolved to field indexes once, so that rows
+            # can be read as plain lists
+            header = next(reader, [])
+            self._bind_columns(header)
+            rows = _padded_rows(reader, len(header))
+            if workers and workers > 1:
+                records = self._records_parallel(rows, id_col, workers)
+            else:
+                records = self._records_serial(rows, id_col)
+            # Values are fully checked on the first record of each spec only,
+            # which keeps the missing-quotes check out of the per-row path.
+            # Non-string values in later rows are caught by values_sql.
+            unchecked = set(s for (t, i, s) in self.specs)
+            for record in records:
+                if unchecked and record.spec in unchecked:
+                    unchecked.discard(record.spec)
+                    record.check_values()
+                yield record
+
+    def _records_serial(self, rows, id_col):
+        header = self.header
+        id_idx = self._id_index(id_col)
+        needs_dict = self.needs_row_dict
+        for (row_num, row) in enumerate(rows):
+            row_dict = dict(zip(header, row)) if needs_dict else None
+            row_id = row[id_idx] if id_col else row_num
+            yield from self._records_for_row(row, row_dict, row_id)
+
+    def _records_parallel(self, rows, id_col, workers):
+        # Specs without XReferences are converted by the workers, the rest
+        # are added here once the values they may refer to are back. The
+        # specs hold lambdas and can't be pickled, so the workers get this
+        # importer through the pool initializer, which a forked process
+        # inherits rather than unpickles.
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print('WARNING: Parallel import needs the fork start method, '
+                  'importing in a single process')
+            yield from self._records_serial(rows, id_col)
+            return
+        header = self.header
+        id_idx = self._id_index(id_col)
+        xref_free = self._xref_free_specs()
+        # The main process only needs the row as a dict for XReferencing
+        # specs
+        need_dict = (self.needs_row_dict and
+                     len(xref_free) < len(self.specs))
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(workers, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            # Keep a bounded number of chunks in flight so the input is
+            # still streamed
+            pending = deque()
+            chunks = _chunks(rows, PARALLEL_CHUNK_SIZE)
             row_num = 0
-            for row in reader:
-                row_id = row[id_col] if id_col else row_num
-                records += self._records_for_row(row, row_id)
+            while True:
+                for chunk in islice(chunks, 2 * workers - len(pending)):
+                    pending.append((chunk,
+                                    executor.submit(_convert_chunk, chunk)))
+                if not pending:
+                    break
+                (chunk, future) = pending.popleft()
+                for (row, converted) in zip(chunk, future.result()):
+                    row_dict = dict(zip(header, row)) if need_dict else None
+                    row_id = row[id_idx] if id_col else row_num
+                    xref_map = {}
+                    conditions = {}
+                    for (table, instance, spec) in self.specs:
+                        record = DbRecord(table, row_id, spec)
+                        if spec in xref_free:
+                            values = converted[xref_free[spec]]
+                            if values is None:
+                                continue
+                            record.attributes = dict(zip(spec.columns,
+                                                         values))
+                        elif not _condition_holds(spec, row_dict, conditions):
+                            continue
+                        else:
+                            record.import_attributes(xref_map, row, row_dict)
+                        xref_map[spec] = record
+                        yield record
+                    row_num += 1
+
+    def _xref_free_specs(self):
+        # {spec: position} of the specs that contain no XReference
+        free = [s for (t, i, s) in self.specs
+                if not any(isinstance(v, XReference)
+                           for v in s.attr_map.values())]
+        return {s: n for (n, s) in enumerate(free)}
+
+    def _convert_chunk(self, chunk):
+        # Worker side of _records_parallel: the attribute values of every
+        # XReference free spec for each row, or None where the condition
+        # does not hold
+        header = self.header
+        xref_free = self._xref_free_specs()
+        converted = []
+        needs_dict = self.needs_row_dict
+        for row in chunk:
+            row_dict = dict(zip(header, row)) if needs_dict else None
+            values = []
+            conditions = {}
+            for spec in xref_free:
+                if not _condition_holds(spec, row_dict, conditions):
+                    values.append(None)
+                    continue
+                record = DbRecord(None, None, spec)
+                record.import_attributes({}, row, row_dict)
+                values.append([record.attributes[c] for c in spec.columns])
+            converted.append(values)
+        return converted
+
+    def import_data_pandas(self, id_col=None, chunksize=100000):
+        # Alternative to import_data: the CSV is parsed by pandas in chunks
+        # and specs made only of ColumnValues and ConstValues (without a
+        # condition) are converted a whole column at a time. All other specs
+        # fall back to the row-by-row path. The records are those of
+        # import_data except for rows with missing fields: pandas can't tell
+        # them from empty ones, so they are read as '' instead of None and
+        # are not reported as errors.
+        if pd is None:
+            print('ERROR: import_data_pandas requires pandas to be installed')
+            exit(-1)
+        quoting = self.dialect.get('quoting', csv.QUOTE_MINIMAL)
+        if quoting not in (csv.QUOTE_MINIMAL, csv.QUOTE_ALL, csv.QUOTE_NONE):
+            # e.g. QUOTE_NONNUMERIC, where csv.reader returns floats
+            print('ERROR: import_data_pandas does not support the quoting '
+                  'mode of this dialect, use import_data')
+            exit(-1)
+        # All values are read as strings, exactly as the csv module does,
+        # since the converters in the specs expect strings. Like csv.reader,
+        # pandas ends lines on either '\r' or '\n', so the dialect's
+        # lineterminator is not used for reading.
+        options = {'sep': self.dialect.get('delimiter', ','),
+                   'quotechar': self.dialect.get('quotechar', '"'),
+                   'quoting': quoting,
+                   'escapechar': self.dialect.get('escapechar'),
+                   'doublequote': self.dialect.get('doublequote', True),
+                   'skipinitialspace': self.dialect.get('skipinitialspace',
+                                                        False)}
+        # index_col=False keeps pandas from turning the first field of rows
+        # with extra fields into an index; extra fields are dropped instead,
+        # just as no spec can address them in import_data
+        chunks = pd.read_csv(self.path, dtype=str, keep_default_na=False,
+                             index_col=False, chunksize=chunksize, **options)
+        column_specs = set(
+            s for (t, i, s) in self.specs if s.condition is _no_condition and
+            all(isinstance(v, (ColumnValue, ConstValue))
+                for v in s.attr_map.values()))
+        unchecked = set(s for (t, i, s) in self.specs)
+        row_num = 0
+        for chunk in chunks:
+            header = list(chunk.columns)
+            if row_num == 0:
+                self._bind_columns(header)
+                id_idx = self._id_index(id_col)
+            columns = {s: {k: _read_column(chunk, v)
+                           for (k, v) in s.attr_map.items()}
+                       for s in column_specs}
+            for (pos, row) in enumerate(chunk.values.tolist()):
+                row_dict = (dict(zip(header, row)) if self.needs_row_dict
+                            else None)
+                row_id = row[id_idx] if id_col else row_num
+                xref_map = {}
+                conditions = {}
+                for (table, instance, spec) in self.specs:
+                    record = DbRecord(table, row_id, spec)
+                    if spec in columns:
+                        record.attributes = {k: v[pos] for (k, v)
+                                             in columns[spec].items()}
+                    elif not _condition_holds(spec, row_dict, conditions):
+                        continue
+                    else:
+                        record.import_attributes(xref_map, row, row_dict)
+                    xref_map[spec] = record
+                    if unchecked and spec in unchecked:
+                        unchecked.discard(spec)
+                        record.check_values()
+                    yield record
                 row_num += 1
-        return records
 
-    def _records_for_row(self, row, row_id):
-        records = []
+    def _bind_columns(self, header):
+        self.header = header
+        self.column_index = index = {name: i for (i, name)
+                                     in enumerate(header)}
+        for (table, instance, spec) in self.specs:
+            for (k, v) in spec.attr_map.items():
+                if isinstance(v, ColumnValue):
+                    names = [v.col_name]
+                elif isinstance(v, MultiColumnValue):
+                    names = v.col_names
+                else:
+                    continue
+                for name in names:
+                    if name not in index:
+                        print('ERROR: Column "{}" used for {} in {} is not in '
+                              'the CSV header'.format(name, k, table))
+                        exit(-1)
+            spec._compile(table, index)
+        # Rows only have to be turned into a {column: value} dict when a
+        # condition, a DynamicValue or a custom value class needs one
+        self.needs_row_dict = any(
+            s.condition is not _no_condition or
+            any(op in (_DYNAMIC, _OTHER) for (k, op, a, e) in s.plan)
+            for (t, i, s) in self.specs)
+
+    def _id_index(self, id_col):
+        if not id_col:
+            return None
+        if id_col not in self.column_index:
+            print('ERROR: ID column "{}" is not in the CSV header'.format(
+                id_col))
+            exit(-1)
+        return self.column_index[id_col]
+
+    def _records_for_row(self, row, row_dict, row_id):
         xref_map = {}
+        conditions = {}
         for (table, instance, spec) in self.specs:
-            if spec.condition(row) is False:
+            if not _condition_holds(spec, row_dict, conditions):
                 continue
             # Create record and import attributes according to spec
-            record = DbRecord(table, row_id)
-            record.import_attributes(spec.attr_map, xref_map, row)
-            records.append(record)
+            record = DbRecord(table, row_id, spec)
+            record.import_attributes(xref_map, row, row_dict)
             # Keep a reference to each record instance that we create for
             # resolving XReferences in later instances
-            instance_path = (table, instance)
-            xref_map[instance_path] = record
-
-        return records
+            xref_map[spec] = record
+            yield record
 
 
 class RecordSpec(object):
+    __slots__ = ('attr_map', 'condition', 'columns', 'const_map',
+                 'dynamic_map', 'columns_sql', 'insert_prefix', 'plan')
+
     def __init__(self, attr_map, condition=None):
         self.attr_map = attr_map
-        self.condition = condition if condition else lambda row: True
+        # condition(row) must not have side effects: the importer evaluates
+        # a condition shared by several specs only once per row
+        self.condition = condition if condition else _no_condition
+        # The column list is fixed by the spec, so the SQL for it is built
+        # once here instead of for every record
+        self.columns = list(attr_map.keys())
+        # Constant values are the same for every record, only the remaining
+        # values have to be read per row
+        self.const_map = {k: v.value for (k, v) in attr_map.items()
+                          if isinstance(v, ConstValue)}
+        self.dynamic_map = {k: v for (k, v) in attr_map.items()
+                            if not isinstance(v, ConstValue)}
+        self.columns_sql = ' (%s)' % ', '.join(self.columns)
+        self.insert_prefix = None
+        self.plan = None
+
+    def _bind(self, table_name):
+        # A copy of this spec for one table of a CsvImporter. The importer
+        # only ever changes its copies, never the spec it was given.
+        bound = copy.copy(self)
+        bound.dynamic_map = dict(self.dynamic_map)
+        bound.insert_prefix = ('INSERT INTO ' + table_name +
+                               self.columns_sql + ' VALUES (')
+        return bound
+
+    def _compile(self, table_name, index):
+        # Translate dynamic_map into a plan of (key, opcode, arg, extra)
+        # entries for _read_values, with columns resolved to field indexes
+        # through index ({column name: position}).
+        self.plan = []
+        for (k, v) in self.dynamic_map.items():
+            if isinstance(v, ColumnValue):
+                entry = (k, _COLUMN, index[v.col_name], v.convert)
+            elif isinstance(v, MultiColumnValue):
+                col_idxs = [(name, index[name]) for name in v.col_names]
+                entry = (k, _MULTI_COLUMN, col_idxs, v.convert)
+            elif isinstance(v, DynamicValue):
+                entry = (k, _DYNAMIC, v.generate, None)
+            elif isinstance(v, _BoundXRef):
+                entry = (k, _XREF, v.target_spec, v.attribute_name)
+            elif hasattr(v, '_read'):
+                entry = (k, _OTHER, v, None)
+            else:
+                print('ERROR: The RecordSpec for {} in {} does not seem to be '
+                      'valid'.format(k, table_name))
+                exit(-1)
+            self.plan.append(entry)
 
 
 class ColumnValue(object):
+    __slots__ = ('col_name', 'convert')
+
     def __init__(self, col_name, convert=None):
         self.col_name = col_name
         self.convert = convert
 
     def _read(self, row, **kw_args):
-        value = row[self.col_name]
+        value = kw_args['row_dict'][self.col_name]
         return self.convert(value) if self.convert else value
 
 
 class MultiColumnValue(object):
+    __slots__ = ('col_names', 'convert')
+
     def __init__(self, col_names, convert):
         if not convert:
             raise ValueError('ERROR: You must provide a convert function')
@@ -90,11 +389,14 @@ class MultiColumnValue(object):
         self.convert = convert
 
     def _read(self, row, **kw_args):
-        values = {key: row[key] for key in self.col_names}
+        row_dict = kw_args['row_dict']
+        values = {key: row_dict[key] for key in self.col_names}
         return self.convert(values)
 
 
 class ConstValue(object):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -103,47 +405,62 @@ class ConstValue(object):
 
 
 class DynamicValue(object):
+    __slots__ = ('generate',)
+
     def __init__(self, generate):
         self.generate = generate
 
     def _read(self, row, **kw_args):
-        return self.generate(row)
+        return self.generate(kw_args['row_dict'])
 
 
 class XReference(object):
+    __slots__ = ('table_name', 'instance_name', 'attribute_name')
+
     def __init__(self, table_name, instance_name, attribute_name):
         self.table_name = table_name
         self.instance_name = instance_name
         self.attribute_name = attribute_name
 
     def _read(self, row, **kw_args):
-        existing_records = kw_args['user_data.txt']
-        path = (self.table_name, self.instance_name)
-        value = existing_records[path].attributes[self.attribute_name]
-        return value
+        # CsvImporter replaces XReferences by _BoundXRefs, which look up the
+        # referenced record by its spec
+        raise RuntimeError('ERROR: XReference to {}.{} in {} can only be '
+                           'read once it is bound by a CsvImporter'.format(
+                               self.instance_name, self.attribute_name,
+                               self.table_name))
+
+
+class _BoundXRef(object):
+    # An XReference resolved by CsvImporter to the RecordSpec it refers to
+    __slots__ = ('target_spec', 'attribute_name')
+
+    def __init__(self, target_spec, attribute_name):
+        self.target_spec = target_spec
+        self.attribute_name = attribute_name
+
+    def _read(self, row, **kw_args):
+        existing_records = kw_args['existing_records']
+        return existing_records[self.target_spec].attributes[
+            self.attribute_name]
 
 
 class DbRecord(object):
-    def __init__(self, table_name, row_id):
+    __slots__ = ('row_id', 'table_name', 'spec', 'attributes')
+
+    def __init__(self, table_name, row_id, spec):
         self.row_id = row_id
         self.table_name = table_name
+        self.spec = spec
         self.attributes = {}
 
-    def import_attributes(self, attr_map, existing_records, row):
-        try:
-            imported = {k: v._read(row, existing_records=existing_records)
-                        for (k, v) in attr_map.items()}
-        except AttributeError:
-            k, v = next((k, v) for (k, v) in attr_map.items()
-                        if '_read' not in dir(v))
-            print('ERROR: The RecordSpec for {} in {} does not seem to be '
-                  'valid'.format(k, self.table_name))
-            exit(-1)
-        self.attributes.update(imported)
+    def import_attributes(self, existing_records, row, row_dict=None):
+        spec = self.spec
+        attributes = dict(spec.const_map)
+        _read_values(spec.plan, attributes, row, row_dict, existing_records)
+        self.attributes = attributes
 
-    def insert_statement(self):
-        col = ' (%s)' % ', '.join(self.attributes.keys())
-        # sanity checks
+    def check_values(self):
         error = False
         for k, v in self.attributes.items():
             if not isinstance(v, str):
@@ -152,37 +469,192 @@ class DbRecord(object):
                       'values (i.e. \'5\', \'TRUE\', \'"Some text"\', '
                       '...)'.format(v, k, self.table_name))
                 error = True
-            elif string_exp.match(v):
+            elif (v[:1] not in '"\'' and letter_exp.search(v) and
+                  v.partition('(')[0].strip().lower() not in sql_fun_set):
                 print('WARNING: {} looks like a string value but is not in '
                       'quotes. If "{}" in "{}" is a CHAR or VARCHAR type '
-                      'column, you should put the value in quotes.').\
-                    format(v, k, self.table_name)
+                      'column, you should put the value in quotes.'.
+                      format(v, k, self.table_name))
         if error:
             print('Aborting due to errors.')
             exit(-1)
-        val = ' (%s)' % ', '.join(self.attributes.values())
-        sql = 'INSERT INTO ' + self.table_name + col + ' VALUES' + val + ';\n'
-        return sql
+
+    def values_sql(self):
+        attributes = self.attributes
+        try:
+            return ', '.join([attributes[c] for c in self.spec.columns])
+        except TypeError:
+            # A value that is not a string; check_values reports which one
+            # and aborts
+            self.check_values()
+            raise
+
+    def insert_statement(self):
+        return self.spec.insert_prefix + self.values_sql() + ');\n'
+
+
+class SqlWriter(object):
+    # f must be opened in binary mode, statements are encoded per flush
+    def __init__(self, f, batch_size=1000, encoding='utf-8'):
+        self.f = f
+        self.batch_size = batch_size
+        self.encoding = encoding
+        # {spec: [values_sql, ...]}. There is one batch per spec, not per
+        # table: specs of the same table can sit on both sides of another
+        # table in the XReference order. A spec's records always come after
+        # those of the specs it refers to, so its batch is created later,
+        # and batches are flushed in the order they were created.
+        self.batches = {}
+
+    def write(self, record):
+        spec = record.spec
+        batch = self.batches.get(spec)
+        if batch is None:
+            batch = self.batches[spec] = []
+        batch.append(record.values_sql())
+        if len(batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # One multi-row INSERT per spec: INSERT ... VALUES (...), (...);
+        # All of them are encoded and written with a single call.
+        statements = []
+        for (spec, batch) in self.batches.items():
+            if batch:
+                statements.append(spec.insert_prefix + '), ('.join(batch) +
+                                  ');\n')
+                del batch[:]
+        if statements:
+            self.f.write(''.join(statements).encode(self.encoding))
 # Private (internal) methods
 
 
+def _padded_rows(reader, width):
+    for row in reader:
+        if len(row) < width:
+            # Skip blank lines and pad short rows like DictReader
+            if not row:
+                continue
+            row += [None] * (width - len(row))
+        yield row
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# The importer of a worker process of CsvImporter._records_parallel, only
+# ever set in the worker
+_worker_importer = None
+
+
+def _init_worker(importer):
+    global _worker_importer
+    _worker_importer = importer
+
+
+def _convert_chunk(chunk):
+    return _worker_importer._convert_chunk(chunk)
+
+
+# Opcodes of the entries in RecordSpec.plan
+_COLUMN, _MULTI_COLUMN, _DYNAMIC, _XREF, _OTHER = range(5)
+
+
+def _read_values(plan, values, row, row_dict, existing_records):
+    # Inner loop of the import. Reads the non constant attributes of a spec
+    # into values, dispatching on the opcode rather than calling _read() with
+    # keyword arguments for every value.
+    for (k, op, arg, extra) in plan:
+        if op == _COLUMN:
+            value = row[arg]
+            values[k] = extra(value) if extra else value
+        elif op == _XREF:
+            values[k] = existing_records[arg].attributes[extra]
+        elif op == _MULTI_COLUMN:
+            values[k] = extra({name: row[i] for (name, i) in arg})
+        elif op == _DYNAMIC:
+            values[k] = arg(row_dict)
+        else:
+            values[k] = arg._read(row, existing_records=existing_records,
+                                  row_dict=row_dict)
+
+
+def _no_condition(row):
+    return True
+
+
+def _condition_holds(spec, row_dict, conditions):
+    # Specs often share a condition, so each one is evaluated only once per
+    # row; conditions is the {condition: result} cache of the current row
+    condition = spec.condition
+    if condition is _no_condition:
+        return True
+    holds = conditions.get(condition)
+    if holds is None:
+        holds = conditions[condition] = condition(row_dict)
+    return holds is not False
+
+
+def _read_column(chunk, value):
+    # Convert a ColumnValue or ConstValue for a whole pandas chunk
+    if isinstance(value, ConstValue):
+        return [value.value] * len(chunk)
+    column = chunk[value.col_name]
+    if value.convert:
+        column = column.map(value.convert)
+    return column.tolist()
+
+
+def _transitive_reduction(data):
+    # Drop self dependencies and the dependencies that are also reachable
+    # through another dependency, they don't change the order. Items on a
+    # cycle keep all of theirs so that _toposort can still report it.
+    reduced = {}
+    for (item, deps) in data.items():
+        deps = deps - set([item])
+        indirect = set()
+        stack = [d for dep in deps for d in data.get(dep, ()) if d != dep]
+        while stack:
+            dep = stack.pop()
+            if dep not in indirect:
+                indirect.add(dep)
+                stack.extend(d for d in data.get(dep, ()) if d != dep)
+        reduced[item] = set(deps) if item in indirect else deps - indirect
+    return reduced
+
+
 def _toposort(data):
     # Ignore self dependencies.
     for k, v in data.items():
         v.discard(k)
-    # Find all items that don't depend on anything.
-    extra_items = reduce(set.union, data.values()) - set(data.keys())
-    # Add empty dependences where needed
-    data.update({item: set() for item in extra_items})
-    while True:
-        ordered = set(item for item, dep in data.items() if not dep)
-        if not ordered:
-            break
+    # Items that only appear as dependencies don't depend on anything.
+    items = set(data.keys()).union(*data.values())
+    # Count the unresolved dependencies of every item (Kahn's algorithm) and
+    # remember which items are waiting on it.
+    pending = {item: len(data.get(item, ())) for item in items}
+    dependents = defaultdict(list)
+    for item, deps in data.items():
+        for dep in deps:
+            dependents[dep].append(item)
+    ordered = set(item for item, count in pending.items() if count == 0)
+    while ordered:
         yield ordered
-        data = {item: (dep - ordered)
-                for item, dep in data.iteritems() if item not in ordered}
-    assert not data, "Cyclic dependencies:\n%s" % \
-        '\n'.join(repr(x) for x in data.iteritems())
+        resolved = set()
+        for item in ordered:
+            del pending[item]
+            for dependent in dependents[item]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    resolved.add(dependent)
+        ordered = resolved
+    assert not pending, "Cyclic dependencies:\n%s" % \
+        '\n'.join(repr((x, data[x])) for x in pending)
 
 
 def parse_args():
@@ -194,65 +666,66 @@ def parse_args():
                         help='CSV dialect to use (default: excel)')
     parser.add_argument('-i', '--id-col', default=None,
                         help='Column to use as a unique ID for each row')
-    parser.add_argument('-s', '--spec-file', default=None,
-                        help='File containing the specs for the INSERT '
-                             'statements')
+    parser.add_argument('-s', '--spec-file', required=True,
+                        help='Python file defining import_specs, the '
+                             '{table: {instance: RecordSpec}} specs for the '
+                             'INSERT statements')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help='Number of rows per INSERT statement '
+                             '(default: 1000)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes used to convert '
+                             'rows (default: convert in this process)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Print progress messages')
     args = parser.parse_args()
     return args
 
 
-def _read_csv(csv_file, dialect):
-    with open(csv_file, 'user_data') as f:
-        reader = csv.DictReader(f, dialect=dialect)
-        rows = [row for row in reader]
-    return rows
+def _get_dialect(name):
+    # CsvImporter expects the dialect as a dict of csv formatting parameters
+    dialect = csv.get_dialect(name)
+    params = ('delimiter', 'doublequote', 'escapechar', 'lineterminator',
+              'quotechar', 'quoting', 'skipinitialspace')
+    return {p: getattr(dialect, p) for p in params}
 
 
 def _read_spec(spec_file):
-    with open(spec_file, 'user_data.json') as f:
-        spec = json.load(f)
-    return spec
-
-
-def _get_table_names(spec):
-    return spec.keys()
-
+    # Specs hold converters and conditions, so they are written in Python.
+    # The spec file is run with the spec classes of this module already in
+    # scope (importing them would load a second copy of this script) and
+    # must define import_specs.
+    namespace = {'RecordSpec': RecordSpec, 'ColumnValue': ColumnValue,
+                 'MultiColumnValue': MultiColumnValue,
+                 'ConstValue': ConstValue, 'DynamicValue': DynamicValue,
+                 'XReference': XReference}
+    with open(spec_file) as f:
+        code = compile(f.read(), spec_file, 'exec')
+    exec(code, namespace)
+    if not isinstance(namespace.get('import_specs'), dict):
+        print('ERROR: {} does not define an import_specs dict'.format(
+            spec_file))
+        exit(-1)
+    return namespace['import_specs']
 
-def _get_table_spec(spec, table_name):
-    return spec[table_name]
 
 # the main function that calls all functions
 
 
 def main():
     args = parse_args()
-    rows = _read_csv(args.csv_file, args.dialect)
     spec = _read_spec(args.spec_file)
-    table_names = _get_table_names(spec)
-    table_specs = {table_name: _get_table_spec(spec, table_name)
-                   for table_name in table_names}
-    # sort the tables so that dependencies are met
-    sorted_tables = [list(tables)[0] for tables in _toposort(table_specs)]
-    # create the DbRecord objects
-    records = {}
-    for table_name in sorted_tables:
-        table_spec = table_specs[table_name]
-        for row in rows:
-            row_id = row[args.id_col] if args.id_col else None
-            record = DbRecord(table_name, row_id)
-            record.import_attributes(table_spec, records, row)
-            records[(table_name, row_id)] = record
-    # write the SQL statements to the output file
-    with open(args.sql_file, 'w') as f:
-        for table_name in sorted_tables:
-            for row in rows:
-                row_id = row[args.id_col] if args.id_col else None
-                record = records[(table_name, row_id)]
-                f.write(record.insert_statement())
+    importer = CsvImporter(args.csv_file, _get_dialect(args.dialect), spec)
+    # Stream the CSV once and write the records in multi-row INSERTs
+    with open(args.sql_file, 'wb', buffering=SQL_BUFFER_SIZE) as f:
+        writer = SqlWriter(f, args.batch_size)
+        for record in importer.import_data(id_col=args.id_col,
+                                           workers=args.workers):
+            writer.write(record)
+        writer.flush()
     if args.verbose:
         print('Done.')
 
 
-main()
+if __name__ == '__main__':
+    main()